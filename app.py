@@ -1,4 +1,5 @@
 #!/usr/bin/env python3
+import os
 import subprocess
 import sys
 from flask import Flask, render_template, request, jsonify
@@ -6,13 +7,43 @@ from flask_socketio import SocketIO, emit
 
 sys.path.append("./refresh_extract")
 
-from refresh_extract import main
+from refresh_extract import main, file_paths, config as app_config, job_backend, places_store
+
+# load and validate configuration once - a bad configuration stops the worker from booting
+config_store = app_config.ConfigStore(f'{file_paths.CONFIG_DIR}/config.yaml')
+config_store.load()
+main.initialize_runtime(config_store.get())
+config_store.add_listener(main.apply_logging_level)
+# parse every profile's content inventory snapshot up front rather than in the first refresh
+for profile in config_store.current.profiles.values():
+    main.get_inventory(profile)
+main.apply_places_key_limits(config_store.current)
+config_store.add_listener(main.apply_places_key_limits)
 
 app = Flask(__name__)
 app.config["SECRET_KEY"] = "secret!"
 socketio = SocketIO(app,
                     cors_allowed_origins='*',
-                    ping_timeout=60000)
+                    ping_timeout=60000,
+                    message_queue=config_store.current.socketio_message_queue)
+
+# jobs, locks and progress messages are shared with every other worker through the job backend
+backend = job_backend.create_backend(config_store.current.job_backend or f'sqlite:///{file_paths.DATA_DIR}/jobs.db')
+if config_store.current.socketio_message_queue:
+    # Flask-SocketIO fans emits out to every worker through the message queue
+    emitter = socketio
+else:
+    emitter = job_backend.BackendEmitter(backend)
+    socketio.start_background_task(job_backend.relay_messages, backend, socketio, socketio.sleep)
+
+WORKER_ID = f'{os.uname().nodename}-{os.getpid()}'
+for worker_number in range(config_store.current.job_concurrency):
+    socketio.start_background_task(main.run_job_worker, backend, config_store, emitter,
+                                   f'{WORKER_ID}-{worker_number}', socketio.sleep)
+if config_store.current.store_compaction_interval:
+    socketio.start_background_task(places_store.run_compaction, main.get_places_store(), backend, WORKER_ID,
+                                   socketio.sleep, config_store.current.store_compaction_interval)
+socketio.start_background_task(config_store.watch, socketio.sleep)
 
 
 @app.route('/')
@@ -22,11 +53,28 @@ def index():
 @app.route('/runAction', methods=['POST'])
 def runAction():
     request_data = request.get_json()
-    main.embedded_start(request_data["query"], socketio)
-    resp = jsonify(success=True)
+    try:
+        config = config_store.get(request_data.get("profile"))
+    except app_config.ConfigError as e:
+        return jsonify(success=False, error=str(e)), 400
+    job_key = f'{config.profile_name}:{request_data["query"]}'
+    lock_key = f'{config.server_url}|{config.site_id}|{config.target_project_name}|{config.target_datasource_name}'
+    job_id, created = backend.submit(job_key, lock_key, {"query": request_data["query"],
+                                                         "profile": config.profile_name})
+    if not created:
+        emitter.emit('push-message', f'Refresh for [{request_data["query"]}] is already queued...', broadcast=True)
+    resp = jsonify(success=True, job_id=job_id)
     return resp
 
 
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    job = backend.get(job_id)
+    if not job:
+        return jsonify(success=False, error='Job not found'), 404
+    return jsonify(success=True, job_id=job_id, status=job['status'], error=job.get('error'))
+
+
 @app.route('/incoming', methods=['POST'])
 def incoming():
     print('INCOMING EVENT')
@@ -35,7 +83,7 @@ def incoming():
     resource_name = request_data['resource_name']
     print(f'INCOMING: {event_type} | {resource_name}')
     if (event_type == 'DatasourceCreated' and resource_name == 'GooglePlacesData'):
-        socketio.emit('refresh-data', f'Webhook {event_type} received <br/>Resource "{resource_name}"', broadcast=True)
+        emitter.emit('refresh-data', f'Webhook {event_type} received <br/>Resource "{resource_name}"', broadcast=True)
     resp = jsonify(success=True)
     return resp
 
@@ -0,0 +1,342 @@
+"""
+Application Configuration
+Loads and validates the configuration once, resolves the named profiles (server, site and target)
+and hot-reloads the file in the background when its modification time changes
+"""
+import logging
+import os
+import threading
+import time
+from dataclasses import dataclass, field, fields
+from typing import Callable, Dict, List, Optional, Tuple
+
+import yaml
+
+LOGGER = logging.getLogger()
+
+DEFAULT_PROFILE_NAME = 'default'
+DEFAULT_RELOAD_INTERVAL = 5.0
+LOGGING_LEVELS = ('DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL')
+
+# environment variables used when no configuration file is present
+ENV_VARS = {
+    'server_url': 'TABLEAU_SERVER_URL',
+    'site_id': 'TABLEAU_SITE_ID',
+    'username': 'TABLEAU_USERNAME',
+    'password': 'TABLEAU_PASSWORD',
+    'access_token_id': 'TABLEAU_ACCESS_TOKEN_ID',
+    'access_token_secret': 'TABLEAU_ACCESS_TOKEN_SECRET',
+    'google_maps_api_key': 'GOOGLE_MAPS_API_ID',
+    'google_maps_api_secret': 'GOOGLE_MAPS_API_SECRET',
+    'target_datasource_name': 'TABLEAU_TARGET_DATASOURCE_NAME',
+    'target_project_name': 'TABLEAU_TARGET_PROJECT_NAME',
+    'google_maps_api_key_pool': 'GOOGLE_MAPS_API_KEY_POOL',
+}
+
+# settings given as lists (or comma separated strings in environment variables)
+LIST_KEYS = ('google_maps_api_key_pool', 'google_places_fields', 'hyper_column_allowlist', 'hyper_sort_columns')
+
+# environment variables for application-wide settings
+APP_ENV_VARS = {
+    'job_backend': 'JOB_BACKEND_URL',
+    'socketio_message_queue': 'SOCKETIO_MESSAGE_QUEUE',
+    'job_concurrency': 'JOB_CONCURRENCY',
+}
+
+# application settings read once at startup - changing them in a reload needs a restart
+RESTART_KEYS = ('job_backend', 'socketio_message_queue', 'job_concurrency', 'store_compaction_interval')
+
+# top-level keys that apply to the whole application rather than to a profile
+APP_KEYS = ('profiles', 'default_profile', 'config_reload_interval', 'job_backend', 'socketio_message_queue',
+            'job_concurrency', 'store_compaction_interval')
+
+
+class ConfigError(ValueError):
+    """Raised when the configuration cannot be loaded or fails validation"""
+
+
+@dataclass(frozen=True)
+class Settings:
+    """Resolved settings for a single named profile
+
+    Instances are immutable, so a refresh that is already running keeps the settings it started
+    with even when the configuration file is reloaded underneath it.
+    """
+
+    profile_name: str
+    server_url: str
+    target_datasource_name: str
+    target_project_name: str
+    site_id: str = ''
+    username: Optional[str] = None
+    password: Optional[str] = field(default=None, repr=False)
+    access_token_id: Optional[str] = None
+    access_token_secret: Optional[str] = field(default=None, repr=False)
+    google_maps_api_key: Optional[str] = None
+    google_maps_api_secret: Optional[str] = field(default=None, repr=False)
+    google_maps_api_key_pool: Tuple[str, ...] = field(default=(), repr=False)
+    google_maps_qps_per_key: float = 10.0
+    google_places_fields: Tuple[str, ...] = ()
+    google_places_concurrency: int = 8
+    hyper_optimize: bool = True
+    hyper_column_allowlist: Tuple[str, ...] = ()
+    hyper_sort_columns: Tuple[str, ...] = ('query_text', 'place_id')
+    logging_level: str = 'INFO'
+
+    @property
+    def google_maps_api_keys(self):
+        """Every Google Maps API key for the profile, google_maps_api_secret first"""
+        keys = ((self.google_maps_api_secret,) if self.google_maps_api_secret else ()) + self.google_maps_api_key_pool
+        return tuple(dict.fromkeys(keys))
+
+    def validate(self):
+        """Check the profile is usable and raise ConfigError describing every problem found"""
+        problems = list()
+        if not self.server_url:
+            problems.append('server_url is required')
+        elif not self.server_url.startswith(('http://', 'https://')):
+            problems.append(f'server_url must start with http:// or https:// (got "{self.server_url}")')
+        if not ((self.username and self.password) or (self.access_token_id and self.access_token_secret)):
+            problems.append('either username/password or access_token_id/access_token_secret is required')
+        if not self.target_datasource_name:
+            problems.append('target_datasource_name is required')
+        if not self.target_project_name:
+            problems.append('target_project_name is required')
+        if not self.google_maps_api_keys:
+            problems.append('google_maps_api_secret or google_maps_api_key_pool is required')
+        if self.google_maps_qps_per_key <= 0:
+            problems.append('google_maps_qps_per_key must be greater than 0')
+        if self.google_places_concurrency < 1:
+            problems.append('google_places_concurrency must be at least 1')
+        if not isinstance(self.hyper_optimize, bool):
+            problems.append('hyper_optimize must be true or false')
+        if self.logging_level not in LOGGING_LEVELS:
+            problems.append(f'logging_level must be one of {", ".join(LOGGING_LEVELS)} (got "{self.logging_level}")')
+
+        if problems:
+            raise ConfigError(f'Invalid configuration for profile "{self.profile_name}": {"; ".join(problems)}')
+
+
+@dataclass(frozen=True)
+class AppConfig:
+    """Validated application configuration holding every named profile"""
+
+    profiles: Dict[str, Settings]
+    default_profile: str
+    source: str
+    reload_interval: float = DEFAULT_RELOAD_INTERVAL
+    job_backend: Optional[str] = None
+    socketio_message_queue: Optional[str] = None
+    job_concurrency: int = 1
+    store_compaction_interval: float = 3600.0
+    version: int = 1
+
+    def profile(self, profile_name=None):
+        """Return the Settings for a profile, falling back to the default profile
+
+        Args:
+            profile_name (str): (Optional) Name of the profile
+
+        Returns:
+            Settings for the profile
+        """
+        name = profile_name or self.default_profile
+        try:
+            return self.profiles[name]
+        except KeyError:
+            raise ConfigError(f'Configuration profile was not found: {name}')
+
+
+def load_config(config_file_path, version=1):
+    """Load and validate the configuration file, falling back to environment variables
+
+    Args:
+        config_file_path (str): Path to the YAML configuration file
+        version (int): Version number stamped on the returned configuration
+
+    Returns:
+        AppConfig
+    """
+    if os.path.isfile(config_file_path):
+        try:
+            with open(config_file_path) as file:
+                raw = yaml.safe_load(file) or {}
+        except (OSError, yaml.YAMLError) as e:
+            raise ConfigError(f'Unable to read configuration file {config_file_path}: {e}')
+        source = config_file_path
+    else:
+        LOGGER.info(f'No configuration file at {config_file_path}, trying environment variables...')
+        raw = {key: os.getenv(env_var) for key, env_var in ENV_VARS.items()}
+        raw.update({key: os.getenv(env_var) for key, env_var in APP_ENV_VARS.items()})
+        source = 'environment'
+
+    if not isinstance(raw, dict):
+        raise ConfigError(f'Configuration must be a mapping of settings: {source}')
+
+    return _build_app_config(raw, source, version)
+
+
+def _build_app_config(raw, source, version):
+    shared = {key: value for key, value in raw.items() if key not in APP_KEYS}
+    raw_profiles = raw.get('profiles') or {DEFAULT_PROFILE_NAME: {}}
+    if not isinstance(raw_profiles, dict):
+        raise ConfigError('profiles must be a mapping of profile name to settings')
+
+    profiles = dict()
+    for name, overrides in raw_profiles.items():
+        profile = _build_settings(str(name), {**shared, **(overrides or {})})
+        profile.validate()
+        profiles[profile.profile_name] = profile
+
+    default_profile = str(raw.get('default_profile') or next(iter(profiles)))
+    if default_profile not in profiles:
+        raise ConfigError(f'default_profile "{default_profile}" is not one of the configured profiles')
+
+    try:
+        reload_interval = float(raw.get('config_reload_interval') or DEFAULT_RELOAD_INTERVAL)
+    except (TypeError, ValueError):
+        raise ConfigError('config_reload_interval must be a number of seconds')
+
+    try:
+        job_concurrency = int(raw.get('job_concurrency') or 1)
+    except (TypeError, ValueError):
+        raise ConfigError('job_concurrency must be a whole number')
+    if job_concurrency < 1:
+        raise ConfigError('job_concurrency must be at least 1')
+
+    try:
+        store_compaction_interval = float(raw.get('store_compaction_interval', 3600.0) or 0)
+    except (TypeError, ValueError):
+        raise ConfigError('store_compaction_interval must be a number of seconds')
+
+    return AppConfig(profiles=profiles,
+                     default_profile=default_profile,
+                     source=source,
+                     reload_interval=reload_interval,
+                     job_backend=raw.get('job_backend'),
+                     socketio_message_queue=raw.get('socketio_message_queue'),
+                     job_concurrency=job_concurrency,
+                     store_compaction_interval=store_compaction_interval,
+                     version=version)
+
+
+def _build_settings(profile_name, values):
+    known = {f.name for f in fields(Settings)} - {'profile_name'}
+    unknown = sorted(set(values) - known)
+    if unknown:
+        raise ConfigError(f'Unknown configuration keys for profile "{profile_name}": {", ".join(unknown)}')
+
+    # treat blank YAML values (None) as 'not set' so the dataclass defaults apply
+    values = {key: value for key, value in values.items() if value is not None}
+    values['site_id'] = str(values.get('site_id', ''))
+    values['logging_level'] = str(values.get('logging_level', 'INFO')).upper()
+    for key in LIST_KEYS:
+        if key in values:
+            items = values[key].split(',') if isinstance(values[key], str) else values[key]
+            values[key] = tuple(str(item).strip() for item in items if str(item).strip())
+    try:
+        for key, cast in (('google_maps_qps_per_key', float), ('google_places_concurrency', int)):
+            if key in values:
+                values[key] = cast(values[key])
+    except (TypeError, ValueError):
+        raise ConfigError(f'{key} for profile "{profile_name}" must be a number')
+
+    return Settings(profile_name=profile_name,
+                    server_url=values.pop('server_url', ''),
+                    target_datasource_name=values.pop('target_datasource_name', ''),
+                    target_project_name=values.pop('target_project_name', ''),
+                    **values)
+
+
+class ConfigStore:
+    """Holds the current AppConfig and swaps in a new one when the configuration file changes
+
+    The configuration is read from disk once by load() and afterwards only by the background
+    watcher, so serving a request never touches the file system for configuration. A reload that
+    fails validation is logged and the previous configuration stays in effect.
+
+    Args:
+        config_file_path (str): Path to the YAML configuration file
+    """
+
+    def __init__(self, config_file_path):
+        self.config_file_path = config_file_path
+        self._config = None
+        self._file_stamp = None
+        self._lock = threading.Lock()
+        self._listeners: List[Callable[[AppConfig], None]] = list()
+
+    @property
+    def current(self) -> AppConfig:
+        if self._config is None:
+            raise ConfigError('Configuration has not been loaded')
+        return self._config
+
+    def load(self):
+        """Load the configuration for the first time, raising ConfigError if it is invalid"""
+        with self._lock:
+            stamp = self.__get_file_stamp()
+            self._config = load_config(self.config_file_path)
+            self._file_stamp = stamp
+        return self._config
+
+    def get(self, profile_name=None) -> Settings:
+        """Return the Settings of a profile from the in-memory configuration"""
+        return self.current.profile(profile_name)
+
+    def add_listener(self, callback):
+        """Register a callable invoked with the new AppConfig after every successful reload"""
+        self._listeners.append(callback)
+
+    def reload_if_changed(self):
+        """Reload the configuration if the file's modification time or size has changed
+
+        Returns:
+            True if a new configuration was swapped in
+        """
+        stamp = self.__get_file_stamp()
+        if stamp == self._file_stamp:
+            return False
+
+        with self._lock:
+            try:
+                new_config = load_config(self.config_file_path, version=self.current.version + 1)
+            except ConfigError as e:
+                LOGGER.error(f'Configuration reload rejected, keeping version {self.current.version}: {e}')
+                # remember the stamp so a broken file is not re-parsed on every poll
+                self._file_stamp = stamp
+                return False
+            old_config = self._config
+            self._config = new_config
+            self._file_stamp = stamp
+
+        LOGGER.info(f'Configuration reloaded from {new_config.source} (version {new_config.version})')
+        changed = [key for key in RESTART_KEYS if getattr(old_config, key) != getattr(new_config, key)]
+        if changed:
+            LOGGER.warning(f'Configuration changes to {", ".join(changed)} only take effect after a restart')
+        for callback in self._listeners:
+            try:
+                callback(new_config)
+            except Exception as e:
+                LOGGER.exception(e)
+        return True
+
+    def watch(self, sleep=time.sleep):
+        """Poll the configuration file for changes forever - run as a background task
+
+        Args:
+            sleep (callable): Sleep function, i.e. socketio.sleep when running under an async worker
+        """
+        while True:
+            sleep(self.current.reload_interval)
+            try:
+                self.reload_if_changed()
+            except Exception as e:
+                LOGGER.exception(e)
+
+    def __get_file_stamp(self):
+        try:
+            stat = os.stat(self.config_file_path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
@@ -0,0 +1,70 @@
+"""
+Google Places Deduplication
+Merges the rows of overlapping queries (and repeated pages or fetches) into one row per place
+before the Hyper file is built.
+"""
+from dataclasses import dataclass
+
+import pandas as pd
+
+KEY_COLUMN = 'place_id'
+QUERY_COLUMN = 'query_text'
+FRESHNESS_COLUMN = 'fetched_at'
+QUERY_SEPARATOR = ' | '
+
+
+@dataclass(frozen=True)
+class DedupStats:
+    rows_in: int
+    rows_out: int
+
+    @property
+    def duplicates(self):
+        return self.rows_in - self.rows_out
+
+    @property
+    def ratio(self):
+        """Share of the input rows removed as duplicates (0.0 - 1.0)"""
+        return self.duplicates / self.rows_in if self.rows_in else 0.0
+
+    def __str__(self):
+        return f'{self.rows_in} rows -> {self.rows_out} places ({self.ratio:.1%} duplicates removed)'
+
+
+def dedupe_places(df):
+    """Keep one row per place_id with the freshest attributes and every contributing query
+
+    All steps are hash group-bys over the rows, so the cost stays linear in the number of rows.
+    Rows without a place_id cannot be matched and are kept as they are.
+
+    Args:
+        df (DataFrame): Places rows from one or more queries, pages or fetches
+
+    Returns:
+        Tuple of (deduplicated DataFrame, DedupStats)
+    """
+    rows_in = len(df)
+    if not rows_in or KEY_COLUMN not in df:
+        return df, DedupStats(rows_in, rows_in)
+
+    df = df.reset_index(drop=True)
+    keyed = df[df[KEY_COLUMN].notna()]
+    unkeyed = df[df[KEY_COLUMN].isna()]
+
+    # freshest row per place - ties (rows from the same fetch) keep the first row seen
+    if FRESHNESS_COLUMN in keyed:
+        freshness = keyed[FRESHNESS_COLUMN].fillna(pd.Timestamp.min)
+        latest = freshness.groupby(keyed[KEY_COLUMN], sort=False).idxmax()
+        deduped = keyed.loc[latest.values]
+    else:
+        deduped = keyed[~keyed.duplicated(KEY_COLUMN)]
+
+    if QUERY_COLUMN in keyed:
+        pairs = keyed[[KEY_COLUMN, QUERY_COLUMN]].dropna().drop_duplicates()
+        # a group-by sum concatenates the strings without a Python call per place (unlike agg(join))
+        queries = (pairs[QUERY_COLUMN].astype(str) + QUERY_SEPARATOR).groupby(pairs[KEY_COLUMN], sort=False).sum()
+        queries = queries.str[:-len(QUERY_SEPARATOR)]
+        deduped = deduped.assign(**{QUERY_COLUMN: deduped[KEY_COLUMN].map(queries)})
+
+    result = pd.concat([deduped, unkeyed], ignore_index=True) if len(unkeyed) else deduped.reset_index(drop=True)
+    return result, DedupStats(rows_in, len(result))
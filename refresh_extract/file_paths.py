@@ -8,3 +8,4 @@ DATA_STAGING_DIR = os.path.abspath("./data/staging")
 LOG_DIR = os.path.abspath("./logs")
 LOG_FILE_NAME = 'app.log'
 
+INVENTORY_FILE_NAME = 'tableau_inventory.jsonl.gz'
@@ -0,0 +1,87 @@
+"""
+Hyper File Optimizer
+Rewrites a Hyper file into a fresh, compacted database before it is published - keeping only the
+allowlisted columns and clustering the rows on the columns dashboards filter by.
+"""
+import logging
+import os
+from dataclasses import dataclass
+
+from tableauhyperapi import Connection, HyperProcess, TableName, Telemetry, escape_name
+
+LOGGER = logging.getLogger()
+
+SOURCE_ALIAS = 'source'
+TARGET_ALIAS = 'target'
+
+
+@dataclass(frozen=True)
+class OptimizeStats:
+    bytes_before: int
+    bytes_after: int
+    dropped_columns: tuple
+
+    @property
+    def bytes_saved(self):
+        return self.bytes_before - self.bytes_after
+
+    @property
+    def reduction(self):
+        """Share of the original file size saved (0.0 - 1.0)"""
+        return self.bytes_saved / self.bytes_before if self.bytes_before else 0.0
+
+    def __str__(self):
+        return (f'{self.bytes_before / 1048576:.2f} MB -> {self.bytes_after / 1048576:.2f} MB '
+                f'({self.reduction:.1%} smaller, {len(self.dropped_columns)} columns dropped)')
+
+
+def optimize_hyper(hyper_file_path, table_name, column_allowlist=None, sort_columns=None):
+    """Rewrite a Hyper file in place as a compacted copy with sorted rows and allowlisted columns
+
+    Args:
+        hyper_file_path (str): Path to the Hyper file
+        table_name (str): Table in the 'public' schema to rewrite
+        column_allowlist (list): (Optional) Columns to keep - all columns are kept when not given
+        sort_columns (list): (Optional) Columns to cluster the rows on, i.e. common dashboard filters
+
+    Returns:
+        OptimizeStats
+    """
+    optimized_path = f'{os.path.splitext(hyper_file_path)[0]}.optimized.hyper'
+    bytes_before = os.path.getsize(hyper_file_path)
+
+    with HyperProcess(telemetry=Telemetry.DO_NOT_SEND_USAGE_DATA_TO_TABLEAU) as hyper:
+        with Connection(hyper.endpoint) as connection:
+            if os.path.exists(optimized_path):
+                os.remove(optimized_path)
+            connection.catalog.create_database(optimized_path)
+            connection.catalog.attach_database(optimized_path, alias=TARGET_ALIAS)
+            connection.catalog.attach_database(hyper_file_path, alias=SOURCE_ALIAS)
+            source_table = TableName(SOURCE_ALIAS, 'public', table_name)
+            existing = [column.name.unescaped for column in
+                        connection.catalog.get_table_definition(source_table).columns]
+
+            if column_allowlist:
+                missing = [column for column in column_allowlist if column not in existing]
+                if missing:
+                    LOGGER.warning(f'Allowlisted columns not found in {table_name}: {", ".join(missing)}')
+                keep = [column for column in existing if column in column_allowlist]
+            else:
+                keep = existing
+            if not keep:
+                raise ValueError(f'None of the allowlisted columns exist in {table_name}')
+            order = [column for column in (sort_columns or []) if column in keep]
+
+            select_list = ', '.join(escape_name(column) for column in keep)
+            order_by = f' ORDER BY {", ".join(escape_name(column) for column in order)}' if order else ''
+            # a new database written in one ordered pass leaves no fragmentation from earlier appends
+            connection.execute_command(f'CREATE TABLE {TableName(TARGET_ALIAS, "public", table_name)} AS '
+                                       f'(SELECT {select_list} FROM {source_table}{order_by})')
+            connection.catalog.detach_all_databases()
+
+    os.replace(optimized_path, hyper_file_path)
+    stats = OptimizeStats(bytes_before, os.path.getsize(hyper_file_path),
+                          tuple(column for column in existing if column not in keep))
+    if stats.dropped_columns:
+        LOGGER.debug(f'Dropped columns from {table_name}: {", ".join(stats.dropped_columns)}')
+    return stats
@@ -0,0 +1,438 @@
+"""
+Shared Job Backend
+Job queue, single-flight locks and progress fan-out shared by every web worker process (and node)
+so the dashboard extension can run with more than one gunicorn worker.
+
+Backends are selected by URL:
+    sqlite:///path/to/jobs.db   - embedded, single-host multi-process (default)
+    redis://host:6379/0         - multi-node, requires the 'redis' package
+"""
+import json
+import logging
+import sqlite3
+import time
+import uuid
+from contextlib import closing
+
+from refresh_extract.config import ConfigError
+
+LOGGER = logging.getLogger()
+
+JOB_QUEUED = 'queued'
+JOB_RUNNING = 'running'
+JOB_SUCCEEDED = 'succeeded'
+JOB_FAILED = 'failed'
+
+DEFAULT_LEASE_SECONDS = 900
+MESSAGE_RETENTION_SECONDS = 3600
+
+
+def create_backend(backend_url):
+    """Create the job backend described by a URL
+
+    Args:
+        backend_url (str): sqlite:///<path> or redis://<host>:<port>/<db>
+
+    Returns:
+        JobBackend
+    """
+    if backend_url.startswith('sqlite:///'):
+        return SQLiteJobBackend(backend_url[len('sqlite:///'):])
+    if backend_url.startswith(('redis://', 'rediss://')):
+        return RedisJobBackend(backend_url)
+    raise ConfigError(f'Unsupported job backend URL: {backend_url}')
+
+
+class JobBackend:
+    """Interface shared by the job backends
+
+    Jobs are coalesced on job_key (an identical queued request returns the existing job) and
+    serialized on lock_key (two jobs publishing the same datasource never run at the same time).
+    """
+
+    def submit(self, job_key, lock_key, payload):
+        """Queue a job unless an identical one is already waiting
+
+        Returns:
+            Tuple of (job_id, created)
+        """
+        raise NotImplementedError
+
+    def claim(self, worker_id, lease_seconds=DEFAULT_LEASE_SECONDS):
+        """Claim the oldest queued job whose lock_key is free. Returns the job dict or None"""
+        raise NotImplementedError
+
+    def renew(self, job, lease_seconds=DEFAULT_LEASE_SECONDS):
+        """Extend the lease of a claimed job. Returns False if the worker no longer holds the job"""
+        raise NotImplementedError
+
+    def complete(self, job, error=None):
+        """Mark a claimed job as finished and free its lock_key
+
+        Only the worker still holding the job can complete it - a job whose lease expired stays failed.
+
+        Returns:
+            True if the job was completed by this call
+        """
+        raise NotImplementedError
+
+    def get(self, job_id):
+        """Return the job dict for a job id or None"""
+        raise NotImplementedError
+
+    def acquire_lock(self, name, owner, ttl_seconds=DEFAULT_LEASE_SECONDS):
+        """Acquire a named lock shared by all workers. Returns True if the lock is now held by owner"""
+        raise NotImplementedError
+
+    def release_lock(self, name, owner):
+        raise NotImplementedError
+
+    def publish(self, event, message):
+        """Publish a progress message to every worker"""
+        raise NotImplementedError
+
+    def last_message_id(self):
+        """Cursor for the newest message - a relay starting now only sees messages after it"""
+        raise NotImplementedError
+
+    def messages_after(self, cursor, limit=100):
+        """Return a list of (cursor, event, message) published after the cursor"""
+        raise NotImplementedError
+
+
+class SQLiteJobBackend(JobBackend):
+    """Job backend stored in an SQLite database - shared by processes on a single host
+
+    Args:
+        db_path (str): Path to the SQLite database file (created if missing)
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        with closing(self.__connect()) as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.executescript('''
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    job_key TEXT NOT NULL,
+                    lock_key TEXT NOT NULL,
+                    payload TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    worker TEXT,
+                    error TEXT,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL,
+                    lease_expires_at REAL
+                );
+                CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created_at);
+                CREATE TABLE IF NOT EXISTS locks (
+                    name TEXT PRIMARY KEY,
+                    owner TEXT NOT NULL,
+                    expires_at REAL NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS messages (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    event TEXT NOT NULL,
+                    message TEXT NOT NULL,
+                    created_at REAL NOT NULL
+                );
+            ''')
+
+    def submit(self, job_key, lock_key, payload):
+        now = time.time()
+        with closing(self.__connect()) as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            row = conn.execute('SELECT id FROM jobs WHERE job_key = ? AND status = ?',
+                               (job_key, JOB_QUEUED)).fetchone()
+            if row:
+                conn.execute('COMMIT')
+                return row['id'], False
+            job_id = uuid.uuid4().hex
+            conn.execute('INSERT INTO jobs (id, job_key, lock_key, payload, status, created_at, updated_at) '
+                         'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                         (job_id, job_key, lock_key, json.dumps(payload), JOB_QUEUED, now, now))
+            conn.execute('COMMIT')
+        return job_id, True
+
+    def claim(self, worker_id, lease_seconds=DEFAULT_LEASE_SECONDS):
+        now = time.time()
+        with closing(self.__connect()) as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            # a worker that died mid-job must not hold its lock_key forever
+            conn.execute('UPDATE jobs SET status = ?, error = ?, updated_at = ? '
+                         'WHERE status = ? AND lease_expires_at < ?',
+                         (JOB_FAILED, 'Job lease expired', now, JOB_RUNNING, now))
+            row = conn.execute('SELECT * FROM jobs WHERE status = ? AND lock_key NOT IN '
+                               '(SELECT lock_key FROM jobs WHERE status = ?) '
+                               'ORDER BY created_at LIMIT 1',
+                               (JOB_QUEUED, JOB_RUNNING)).fetchone()
+            if row:
+                conn.execute('UPDATE jobs SET status = ?, worker = ?, updated_at = ?, lease_expires_at = ? '
+                             'WHERE id = ?',
+                             (JOB_RUNNING, worker_id, now, now + lease_seconds, row['id']))
+            conn.execute('COMMIT')
+        return self.__to_job(row, status=JOB_RUNNING, worker=worker_id) if row else None
+
+    def renew(self, job, lease_seconds=DEFAULT_LEASE_SECONDS):
+        now = time.time()
+        with closing(self.__connect()) as conn:
+            cursor = conn.execute('UPDATE jobs SET lease_expires_at = ?, updated_at = ? '
+                                  'WHERE id = ? AND status = ? AND worker = ?',
+                                  (now + lease_seconds, now, job['id'], JOB_RUNNING, job['worker']))
+        return cursor.rowcount > 0
+
+    def complete(self, job, error=None):
+        status = JOB_FAILED if error else JOB_SUCCEEDED
+        with closing(self.__connect()) as conn:
+            cursor = conn.execute('UPDATE jobs SET status = ?, error = ?, updated_at = ?, lease_expires_at = NULL '
+                                  'WHERE id = ? AND status = ? AND worker = ?',
+                                  (status, error, time.time(), job['id'], JOB_RUNNING, job['worker']))
+        self.__purge()
+        return cursor.rowcount > 0
+
+    def get(self, job_id):
+        with closing(self.__connect()) as conn:
+            row = conn.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        return self.__to_job(row) if row else None
+
+    def acquire_lock(self, name, owner, ttl_seconds=DEFAULT_LEASE_SECONDS):
+        now = time.time()
+        with closing(self.__connect()) as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            conn.execute('DELETE FROM locks WHERE name = ? AND expires_at < ?', (name, now))
+            conn.execute('INSERT OR IGNORE INTO locks (name, owner, expires_at) VALUES (?, ?, ?)',
+                         (name, owner, now + ttl_seconds))
+            row = conn.execute('SELECT owner FROM locks WHERE name = ?', (name,)).fetchone()
+            conn.execute('COMMIT')
+        return row['owner'] == owner
+
+    def release_lock(self, name, owner):
+        with closing(self.__connect()) as conn:
+            conn.execute('DELETE FROM locks WHERE name = ? AND owner = ?', (name, owner))
+
+    def publish(self, event, message):
+        with closing(self.__connect()) as conn:
+            conn.execute('INSERT INTO messages (event, message, created_at) VALUES (?, ?, ?)',
+                         (event, message, time.time()))
+
+    def last_message_id(self):
+        with closing(self.__connect()) as conn:
+            row = conn.execute('SELECT MAX(id) AS id FROM messages').fetchone()
+        return row['id'] or 0
+
+    def messages_after(self, cursor, limit=100):
+        with closing(self.__connect()) as conn:
+            rows = conn.execute('SELECT id, event, message FROM messages WHERE id > ? ORDER BY id LIMIT ?',
+                                (cursor, limit)).fetchall()
+        return [(row['id'], row['event'], row['message']) for row in rows]
+
+    def __purge(self):
+        cutoff = time.time() - MESSAGE_RETENTION_SECONDS
+        with closing(self.__connect()) as conn:
+            conn.execute('DELETE FROM messages WHERE created_at < ?', (cutoff,))
+            conn.execute('DELETE FROM jobs WHERE status IN (?, ?) AND updated_at < ?',
+                         (JOB_SUCCEEDED, JOB_FAILED, cutoff))
+
+    def __connect(self):
+        # one short-lived connection per call - connections must not be shared between greenlets
+        conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    @staticmethod
+    def __to_job(row, **overrides):
+        job = {key: row[key] for key in ('id', 'job_key', 'lock_key', 'status', 'worker', 'error',
+                                         'created_at', 'updated_at')}
+        job['payload'] = json.loads(row['payload'])
+        job.update(overrides)
+        return job
+
+
+class RedisJobBackend(JobBackend):
+    """Job backend stored in Redis - shared by workers on any number of nodes
+
+    Args:
+        redis_url (str): Redis connection URL
+        prefix (str): Key prefix for everything stored by the backend
+    """
+
+    def __init__(self, redis_url, prefix='refresh_extract'):
+        try:
+            import redis
+        except ImportError:
+            raise ConfigError('The redis package is required for a redis:// job backend (pip install redis)')
+
+        self.client = redis.Redis.from_url(redis_url, decode_responses=True)
+        self.prefix = prefix
+
+        # compare-and-set scripts so a worker never renews or frees a lock another worker now holds
+        self.__renew_script = self.client.register_script('''
+            if redis.call('get', KEYS[1]) == ARGV[1] then
+                return redis.call('pexpire', KEYS[1], ARGV[2])
+            end
+            return 0''')
+        self.__release_script = self.client.register_script('''
+            if redis.call('get', KEYS[1]) == ARGV[1] then
+                return redis.call('del', KEYS[1])
+            end
+            return 0''')
+        self.__complete_script = self.client.register_script('''
+            if redis.call('hget', KEYS[1], 'status') ~= 'running' or redis.call('hget', KEYS[1], 'worker') ~= ARGV[1] then
+                return 0
+            end
+            local completed = 0
+            if redis.call('get', KEYS[2]) == ARGV[2] then
+                redis.call('hset', KEYS[1], 'status', ARGV[3], 'error', ARGV[4], 'updated_at', ARGV[5])
+                redis.call('del', KEYS[2])
+                completed = 1
+            else
+                redis.call('hset', KEYS[1], 'status', 'failed', 'error', 'Job lease expired', 'updated_at', ARGV[5])
+            end
+            redis.call('expire', KEYS[1], ARGV[6])
+            redis.call('lrem', KEYS[3], 0, ARGV[2])
+            return completed''')
+        # claiming is one script, so a worker dying part way through can never lose the job - the
+        # job id moves from the queue to the processing list in the same step as taking its lock
+        self.__claim_script = self.client.register_script('''
+            local job_id = redis.call('rpoplpush', KEYS[1], KEYS[2])
+            if not job_id then
+                return false
+            end
+            local job = ARGV[1] .. ':job:' .. job_id
+            local lock_key = redis.call('hget', job, 'lock_key')
+            if not lock_key then
+                redis.call('lrem', KEYS[2], 0, job_id)
+                return false
+            end
+            if not redis.call('set', ARGV[1] .. ':lock:' .. lock_key, job_id, 'NX', 'PX', ARGV[2]) then
+                -- target busy - send the job to the back of the queue so other targets can proceed
+                redis.call('lrem', KEYS[2], 0, job_id)
+                redis.call('lpush', KEYS[1], job_id)
+                return false
+            end
+            redis.call('del', ARGV[1] .. ':pending:' .. redis.call('hget', job, 'job_key'))
+            redis.call('hset', job, 'status', 'running', 'worker', ARGV[3], 'updated_at', ARGV[4])
+            return job_id''')
+        # a worker that died mid-job leaves its job in the processing list after its lock expired
+        self.__expire_script = self.client.register_script('''
+            local expired = 0
+            for _, job_id in ipairs(redis.call('lrange', KEYS[1], 0, -1)) do
+                local job = ARGV[1] .. ':job:' .. job_id
+                local lock_key = redis.call('hget', job, 'lock_key')
+                if not lock_key then
+                    redis.call('lrem', KEYS[1], 0, job_id)
+                elseif redis.call('get', ARGV[1] .. ':lock:' .. lock_key) ~= job_id then
+                    if redis.call('hget', job, 'status') == 'running' then
+                        redis.call('hset', job, 'status', 'failed', 'error', 'Job lease expired', 'updated_at', ARGV[2])
+                        redis.call('expire', job, ARGV[3])
+                        expired = expired + 1
+                    end
+                    redis.call('lrem', KEYS[1], 0, job_id)
+                end
+            end
+            return expired''')
+
+    def submit(self, job_key, lock_key, payload):
+        job_id = uuid.uuid4().hex
+        # coalesce identical requests while the first one is still waiting in the queue - claim removes the key
+        if not self.client.set(self.__key('pending', job_key), job_id, nx=True):
+            existing = self.client.get(self.__key('pending', job_key))
+            if existing:
+                return existing, False
+
+        now = time.time()
+        self.client.hset(self.__key('job', job_id), mapping={
+            'id': job_id, 'job_key': job_key, 'lock_key': lock_key, 'payload': json.dumps(payload),
+            'status': JOB_QUEUED, 'created_at': now, 'updated_at': now})
+        self.client.lpush(self.__key('queue'), job_id)
+        return job_id, True
+
+    def claim(self, worker_id, lease_seconds=DEFAULT_LEASE_SECONDS):
+        now = time.time()
+        expired = self.__expire_script(keys=[self.__key('processing')],
+                                       args=[self.prefix, now, MESSAGE_RETENTION_SECONDS])
+        if expired:
+            LOGGER.warning(f'Marked {expired} jobs whose lease expired as failed')
+
+        job_id = self.__claim_script(keys=[self.__key('queue'), self.__key('processing')],
+                                     args=[self.prefix, int(lease_seconds * 1000), worker_id, now])
+        return self.get(job_id) if job_id else None
+
+    def renew(self, job, lease_seconds=DEFAULT_LEASE_SECONDS):
+        return bool(self.__renew_script(keys=[self.__key('lock', job['lock_key'])],
+                                        args=[job['id'], int(lease_seconds * 1000)]))
+
+    def complete(self, job, error=None):
+        return bool(self.__complete_script(
+            keys=[self.__key('job', job['id']), self.__key('lock', job['lock_key']), self.__key('processing')],
+            args=[job['worker'], job['id'], JOB_FAILED if error else JOB_SUCCEEDED, error or '', time.time(),
+                  MESSAGE_RETENTION_SECONDS]))
+
+    def get(self, job_id):
+        job = self.client.hgetall(self.__key('job', job_id))
+        if not job:
+            return None
+        job['payload'] = json.loads(job['payload'])
+        return job
+
+    def acquire_lock(self, name, owner, ttl_seconds=DEFAULT_LEASE_SECONDS):
+        return bool(self.client.set(self.__key('named-lock', name), owner, nx=True, px=int(ttl_seconds * 1000)))
+
+    def release_lock(self, name, owner):
+        self.__release(self.__key('named-lock', name), owner)
+
+    def publish(self, event, message):
+        self.client.xadd(self.__key('messages'), {'event': event, 'message': message},
+                         maxlen=1000, approximate=True)
+
+    def last_message_id(self):
+        newest = self.client.xrevrange(self.__key('messages'), count=1)
+        return newest[0][0] if newest else '0-0'
+
+    def messages_after(self, cursor, limit=100):
+        streams = self.client.xread({self.__key('messages'): cursor}, count=limit)
+        if not streams:
+            return []
+        return [(message_id, fields['event'], fields['message']) for message_id, fields in streams[0][1]]
+
+    def __release(self, key, owner):
+        self.__release_script(keys=[key], args=[owner])
+
+    def __key(self, *parts):
+        return ':'.join((self.prefix,) + parts)
+
+
+class BackendEmitter:
+    """Socket.IO-compatible emitter that fans messages out to every worker via the job backend
+
+    Passed to execute_refresh in place of the socketio object; each worker's relay_messages task
+    re-emits the messages to the clients connected to that worker.
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    def emit(self, event, message, broadcast=True, **kwargs):
+        self.backend.publish(event, message)
+
+
+def relay_messages(backend, socketio, sleep=time.sleep, interval=0.25):
+    """Forward messages published by any worker to this worker's Socket.IO clients - runs forever
+
+    Args:
+        backend (JobBackend): Shared job backend
+        socketio (SocketIO): This worker's Flask-SocketIO instance
+        sleep (callable): Sleep function, i.e. socketio.sleep when running under an async worker
+        interval (float): Seconds between polls when no messages are waiting
+    """
+    cursor = backend.last_message_id()
+    while True:
+        try:
+            messages = backend.messages_after(cursor)
+        except Exception as e:
+            LOGGER.exception(e)
+            messages = []
+        for cursor, event, message in messages:
+            socketio.emit(event, message, broadcast=True)
+        if not messages:
+            sleep(interval)
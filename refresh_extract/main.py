@@ -1,21 +1,29 @@
 import argparse
+import functools
 import os
+import shutil
+import threading
 import time
+from datetime import date, datetime
 
 import pantab
-import yaml
 import logging
 import sys
-import googlemaps
 import pandas as pd
 
 sys.path.append(".")
 
 import file_paths
-from refresh_extract import tableau_rest_api_helper, utilities as utils
+from refresh_extract import config as app_config, dedup, hyper_optimizer, job_backend, places_client, \
+    places_store, tableau_rest_api_helper, utilities as utils
 
 MAIN_LOGGER = logging.getLogger()
 
+
+class PublishError(Exception):
+    """Raised when the refreshed extract could not be published to Tableau Server"""
+
+
 def main():
 
     parser = argparse.ArgumentParser(description='Tableau Extract Refresher for Google Places.')
@@ -27,98 +35,163 @@ def main():
     parser.add_argument('--password', '-p', required=False, help='Tableau Password')
     parser.add_argument('--access-token', '-x', required=False, help='Tableau Personal Access Token Id')
     parser.add_argument('--token-secret', '-y', required=False, help='Tableau Token Secret')
-    parser.add_argument('--query-text', '-q', required=True, help='Google Places Search Query String')
+    parser.add_argument('--query-text', '-q', required=False, action='append',
+                        help='Google Places Search Query String (repeat to fetch or rebuild several queries)')
+    parser.add_argument('--from-store', required=False, action='store_true',
+                        help='Rebuild the extract from previously fetched data instead of querying Google Places')
+    parser.add_argument('--start-date', required=False, type=date.fromisoformat,
+                        help='First fetch date (YYYY-MM-DD) to include with --from-store')
+    parser.add_argument('--end-date', required=False, type=date.fromisoformat,
+                        help='Last fetch date (YYYY-MM-DD) to include with --from-store')
+    parser.add_argument('--export-inventory', required=False, action='store_true',
+                        help='Export the Tableau site content inventory snapshot instead of refreshing the extract')
+    parser.add_argument('--inventory-delta', required=False, action='store_true',
+                        help='With --export-inventory, only fetch content updated since the last snapshot')
+    parser.add_argument('--profile', '-r', required=False, help='Configuration Profile Name (defaults to default_profile)')
     args = parser.parse_args()
+    if not (args.from_store or args.export_inventory) and not args.query_text:
+        parser.error('--query-text is required unless --from-store or --export-inventory is given')
 
     # Read configuration file
-    config = init_config(args.config_file)
+    try:
+        config = app_config.load_config(args.config_file).profile(args.profile)
+    except app_config.ConfigError as e:
+        sys.exit(f"Program terminated - {e}")
 
-    # check directories and create if not present
-    utils.check_and_create_dir(file_paths.DATA_DIR)
-    utils.check_and_create_dir(file_paths.LOG_DIR)
-    utils.check_and_create_dir(file_paths.DATA_STAGING_DIR)
+    initialize_runtime(config)
 
-    # clean Data Staging directory
-    utils.clean_directory(file_paths.DATA_STAGING_DIR)
+    # clean the command line's Data Staging directory (leaving any running web worker jobs alone)
+    staging_dir = os.path.join(file_paths.DATA_STAGING_DIR, 'cli')
+    utils.check_and_create_dir(staging_dir)
+    utils.clean_directory(staging_dir)
 
-    # logging
-    console_logging_level = config["logging_level"]
-    if not console_logging_level:
-        console_logging_level = "INFO"
+    ## Create an instance for the Source side
+    tab_rest_api_helper = initialize_rest_api_helper(config, 'tab_rest_1', config.logging_level)
+
+    if args.export_inventory:
+        tab_rest_api_helper.export_inventory(get_inventory_snapshot_path(config), delta=args.inventory_delta)
+    elif args.from_store:
+        execute_rebuild_from_store(tab_rest_api_helper, config, args.query_text, args.start_date, args.end_date,
+                                   staging_dir=staging_dir)
+    elif len(args.query_text) > 1:
+        execute_batch_refresh(tab_rest_api_helper, config, args.query_text, staging_dir=staging_dir)
     else:
-        console_logging_level = console_logging_level.upper()
-    setup_logging(f'{file_paths.LOG_DIR}/{file_paths.LOG_FILE_NAME}', console_logging_level)
+        execute_refresh(tab_rest_api_helper, config, args.query_text[0], staging_dir=staging_dir)
 
-    ## Create an instance for the Source side
-    tab_rest_api_helper = initialize_rest_api_helper(config, 'tab_rest_1', console_logging_level)
 
-    execute_refresh(tab_rest_api_helper, config, args.query_text)
+def initialize_runtime(config):
+    '''Create the working directories and configure logging - called once at startup'''
 
+    # check directories and create if not present
+    utils.check_and_create_dir(file_paths.DATA_DIR)
+    utils.check_and_create_dir(file_paths.LOG_DIR)
+    utils.check_and_create_dir(file_paths.DATA_STAGING_DIR)
 
-def init_config(config_file_path):
+    setup_logging(f'{file_paths.LOG_DIR}/{file_paths.LOG_FILE_NAME}', config.logging_level)
 
-    try_env_vars = False
 
-    # try loading from config file first
-    try:
-        with open(config_file_path) as file:
-            config = yaml.load(file, Loader=yaml.FullLoader)
-    except Exception as e:
-        print(file_paths.CONFIG_DIR)
-        try_env_vars = True
-
-    # try loading from env vars second
-    if try_env_vars:
-        print('No configuration file, trying environment variables...')
-        config = {}
-        config['logging_level'] = 'INFO'
-        config['server_url'] = os.getenv('TABLEAU_SERVER_URL')
-        config['site_id'] = os.getenv('TABLEAU_SITE_ID')
-        config['username'] = os.getenv('TABLEAU_USERNAME')
-        config['password'] = os.getenv('TABLEAU_PASSWORD')
-        config['access_token_id'] = os.getenv('TABLEAU_ACCESS_TOKEN_ID')
-        config['access_token_secret'] = os.getenv('TABLEAU_ACCESS_TOKEN_SECRET')
-        config['google_maps_api_key'] = os.getenv('GOOGLE_MAPS_API_ID')
-        config['google_maps_api_secret'] = os.getenv('GOOGLE_MAPS_API_SECRET')
-        config['target_datasource_name'] = os.getenv('TABLEAU_TARGET_DATASOURCE_NAME')
-        config['target_project_name'] = os.getenv('TABLEAU_TARGET_PROJECT_NAME')
-
-    if not config['server_url']:
-        sys.exit("Program terminated - Configuration values could not be identified...")
-
-    return config
-
-
-def embedded_start(query_text, socketio):
+def apply_logging_level(app_cfg):
+    '''Config reload listener - apply the default profile's console logging level'''
 
-    # Read configuration file
-    config = init_config(f'{file_paths.CONFIG_DIR}/config.yaml')
+    console_logging_level = app_cfg.profile().logging_level
+    MAIN_LOGGER.setLevel(console_logging_level)
+    for handler in MAIN_LOGGER.handlers:
+        if not isinstance(handler, logging.FileHandler):
+            handler.setLevel(console_logging_level)
 
-    # check directories and create if not present
-    utils.check_and_create_dir(file_paths.DATA_DIR)
-    utils.check_and_create_dir(file_paths.LOG_DIR)
-    utils.check_and_create_dir(file_paths.DATA_STAGING_DIR)
 
-    # clean Data Staging directory
-    utils.clean_directory(file_paths.DATA_STAGING_DIR)
+def apply_places_key_limits(app_cfg):
+    '''Config reload listener - set every Google Maps API key's QPS limit and re-enable denied keys
 
-    # logging
-    console_logging_level = config["logging_level"]
-    if not console_logging_level:
-        console_logging_level = "INFO"
-    else:
-        console_logging_level = console_logging_level.upper()
-    setup_logging(f'{file_paths.LOG_DIR}/{file_paths.LOG_FILE_NAME}', console_logging_level)
+    A key shared by several profiles keeps to the strictest of their limits.
+    '''
 
-    ## Create an instance for the Source side
-    tab_rest_api_helper = initialize_rest_api_helper(config, 'tab_rest_1', console_logging_level)
+    key_limits = dict()
+    for profile in app_cfg.profiles.values():
+        qps = profile.google_maps_qps_per_key / get_worker_process_count()
+        for key in profile.google_maps_api_keys:
+            key_limits[key] = min(qps, key_limits.get(key, qps))
+    places_client.configure_keys(key_limits)
 
-    execute_refresh(tab_rest_api_helper, config, query_text, socketio)
 
+def embedded_start(query_text, socketio, config, job_id=None):
 
-def execute_refresh(rest_helper, config, query_text, socketio=None):
+    # each job stages its files in its own directory so concurrent workers never share a hyper file
+    staging_dir = os.path.join(file_paths.DATA_STAGING_DIR, job_id or 'embedded')
+    utils.check_and_create_dir(staging_dir)
+    utils.clean_directory(staging_dir)
 
-    TABLE_NAME = 'google_places'
+    try:
+        ## Create an instance for the Source side
+        tab_rest_api_helper = initialize_rest_api_helper(config, 'tab_rest_1', config.logging_level)
+
+        execute_refresh(tab_rest_api_helper, config, query_text, socketio, staging_dir)
+    finally:
+        shutil.rmtree(staging_dir, ignore_errors=True)
+
+
+def run_job_worker(backend, config_store, socketio, worker_id, sleep=time.sleep, poll_interval=1.0,
+                   lease_seconds=job_backend.DEFAULT_LEASE_SECONDS):
+    '''Claim refresh jobs from the shared job backend and run them - runs forever as a background task
+
+    Args:
+        backend (JobBackend): Shared job backend
+        config_store (ConfigStore): In-memory configuration
+        socketio: Emitter for progress messages (SocketIO or BackendEmitter)
+        worker_id (str): Identifier recorded against claimed jobs
+        sleep (callable): Sleep function, i.e. socketio.sleep when running under an async worker
+        poll_interval (float): Seconds between polls when the queue is empty
+        lease_seconds (float): Job lease, renewed every third of the lease while the job runs
+    '''
+    while True:
+        try:
+            job = backend.claim(worker_id, lease_seconds)
+        except Exception as e:
+            MAIN_LOGGER.exception(e)
+            job = None
+        if not job:
+            sleep(poll_interval)
+            continue
+
+        MAIN_LOGGER.info(f'Worker {worker_id} claimed job {job["id"]}')
+        job_finished = threading.Event()
+        heartbeat = threading.Thread(target=renew_job_lease, args=(backend, job, job_finished, lease_seconds),
+                                     daemon=True)
+        heartbeat.start()
+
+        error = None
+        try:
+            config = config_store.get(job['payload']['profile'])
+            embedded_start(job['payload']['query'], socketio, config, job_id=job['id'])
+        except Exception as e:
+            MAIN_LOGGER.exception(e)
+            error = str(e)
+            socketio.emit('push-message', f'Extract Task Failed: {error}', broadcast=True)
+        finally:
+            job_finished.set()
+            heartbeat.join()
+
+        try:
+            if not backend.complete(job, error):
+                MAIN_LOGGER.error(f'Job {job["id"]} was no longer held by worker {worker_id} when it finished')
+        except Exception as e:
+            MAIN_LOGGER.exception(e)
+
+
+def renew_job_lease(backend, job, job_finished, lease_seconds):
+    '''Keep renewing a running job's lease until job_finished is set'''
+
+    # the gevent worker monkey-patches threading, so this runs as a greenlet next to the job
+    while not job_finished.wait(lease_seconds / 3):
+        try:
+            if not backend.renew(job, lease_seconds):
+                MAIN_LOGGER.error(f'Lost the lease on job {job["id"]} - another worker may run the same target')
+                return
+        except Exception as e:
+            MAIN_LOGGER.exception(e)
+
+
+def execute_refresh(rest_helper, config, query_text, socketio=None, staging_dir=file_paths.DATA_STAGING_DIR):
 
     # get data
     MAIN_LOGGER.info(f'Refreshing Google Places Extract Based on Query: [{query_text}]...')
@@ -127,52 +200,153 @@ def execute_refresh(rest_helper, config, query_text, socketio=None):
         socketio.emit('push-message', f'Querying Google Places API...', broadcast=True)
     extract_data_df = get_google_places_dataframe(config, query_text)
 
+    # land the fetch so the extract can be rebuilt later without calling the API again
+    get_places_store().write(extract_data_df, query_text)
+
+    publish_extract(rest_helper, config, extract_data_df, socketio, staging_dir)
+
+
+def execute_batch_refresh(rest_helper, config, queries, socketio=None, staging_dir=file_paths.DATA_STAGING_DIR):
+    '''Fetch several queries concurrently and publish them as one extract'''
+
+    MAIN_LOGGER.info(f'Refreshing Google Places Extract Based on Queries: {queries}...')
+    if socketio:
+        socketio.emit('push-message', f'Querying Google Places API for {len(queries)} queries...', broadcast=True)
+    dataframes = get_google_places_dataframes(config, queries)
+
+    store = get_places_store()
+    for query_text, df in dataframes.items():
+        store.write(df, query_text)
+
+    publish_extract(rest_helper, config, pd.concat(dataframes.values(), ignore_index=True), socketio, staging_dir)
+
+
+def execute_rebuild_from_store(rest_helper, config, queries=None, start_date=None, end_date=None,
+                               socketio=None, staging_dir=file_paths.DATA_STAGING_DIR):
+    '''Rebuild and publish the extract from previously landed fetches - no Google Places API calls'''
+
+    MAIN_LOGGER.info(f'Rebuilding Google Places Extract from the landing zone for queries {queries or "(all)"} '
+                     f'between {start_date or "(first)"} and {end_date or "(last)"}...')
+    extract_data_df = get_places_store().read(queries, start_date, end_date)
+    if extract_data_df.empty:
+        MAIN_LOGGER.error('No landed Google Places data matched - nothing to publish')
+        return
+
+    publish_extract(rest_helper, config, extract_data_df, socketio, staging_dir)
+
+
+def publish_extract(rest_helper, config, extract_data_df, socketio=None, staging_dir=file_paths.DATA_STAGING_DIR):
+
+    TABLE_NAME = 'google_places'
+
    # create hyper extract and publish
-    hyper_file_path = os.path.join(file_paths.DATA_STAGING_DIR,f'GooglePlacesData.hyper')
+    hyper_file_path = os.path.join(staging_dir, f'GooglePlacesData.hyper')
 
+    # one row per place - overlapping queries, pages and fetches return the same place_id
+    extract_data_df, dedup_stats = dedup.dedupe_places(extract_data_df)
+    MAIN_LOGGER.info(f'Deduplicated Google Places data: {dedup_stats}')
     if socketio:
+        socketio.emit('push-message', f'Deduplicated: {dedup_stats}', broadcast=True)
         socketio.emit('push-message', f'Creating New Hyper File...', broadcast=True)
-    pantab.frame_to_hyper(extract_data_df, hyper_file_path, table=TABLE_NAME, table_mode='a')
-
-    target_datasource_name = config['target_datasource_name']
-    target_project_name = config['target_project_name']
+    pantab.frame_to_hyper(extract_data_df, hyper_file_path, table=TABLE_NAME, table_mode='w')
+
+    optimize_stats = None
+    if config.hyper_optimize:
+        try:
+            optimize_stats = hyper_optimizer.optimize_hyper(hyper_file_path, TABLE_NAME,
+                                                            config.hyper_column_allowlist, config.hyper_sort_columns)
+            MAIN_LOGGER.info(f'Optimized Hyper File: {optimize_stats}')
+        except Exception as e:
+            # the unoptimized file is still valid - publish it rather than failing the refresh
+            MAIN_LOGGER.exception(e)
+
+    target_datasource_name = config.target_datasource_name
+    target_project_name = config.target_project_name
     success = rest_helper.publish_hyper(hyper_file_path, target_datasource_name, target_project_name)
+    MAIN_LOGGER.info(f'Call to publish {target_datasource_name} datasource returned {success}')
+    if not success:
+        # raise so the job is recorded as failed and the dashboard is not told the refresh completed
+        raise PublishError(f'Unable to publish datasource "{target_datasource_name}" '
+                           f'to project "{target_project_name}" - see the log for details')
+
+    if optimize_stats and rest_helper.last_publish_bytes:
+        seconds_per_byte = rest_helper.last_publish_seconds / rest_helper.last_publish_bytes
+        upload_saving = f'{optimize_stats} - about {optimize_stats.bytes_saved * seconds_per_byte:.1f}s less upload time'
+        MAIN_LOGGER.info(f'Hyper File Optimization: {upload_saving}')
+        if socketio:
+            socketio.emit('push-message', f'Optimized Hyper File: {upload_saving}', broadcast=True)
     if socketio:
         socketio.emit('push-message', f'Published Datasource as <br/>"{target_datasource_name}"...', broadcast=True)
 
-    MAIN_LOGGER.info(f'Call to publish {target_datasource_name} datasource returned {success}')
-
     MAIN_LOGGER.info(f'Task Execution Completed')
     if socketio:
         socketio.emit('push-message', f'Extract Task Completed', broadcast=True)
 
 
+@functools.lru_cache(maxsize=1)
+def get_places_store():
+    return places_store.PlacesStore(os.path.join(file_paths.DATA_DIR, 'places'))
+
 
 def get_google_places_dataframe(config, querytext):
 
-    gmaps = googlemaps.Client(config['google_maps_api_secret'])
-    data = list()
-    response = gmaps.places(query=querytext)
-    data.extend(response['results'])
-    while 'next_page_token' in response:
-        time.sleep(2)  #delay is mandatory - API bug
-        response = gmaps.places(query=querytext, page_token=response['next_page_token'])
-        data.extend(response['results'])
-
-    df = pd.json_normalize(data)
-    df = df.drop(columns=['photos', 'types'])
+    results = get_places_client(config).text_search(querytext)
+    return places_results_to_dataframe(results, querytext)
+
+
+def get_google_places_dataframes(config, queries):
+    '''Query Google Places for several queries concurrently - returns a dict of query text to DataFrame'''
+
+    client = get_places_client(config)
+    results_by_query = client.search_many(queries)
+    MAIN_LOGGER.debug(f'Google Places key usage: {client.key_pool.stats()}')
+    return {querytext: places_results_to_dataframe(results, querytext)
+            for querytext, results in results_by_query.items()}
+
+
+@functools.lru_cache(maxsize=8)
+def get_places_client(config):
+    '''One pooled Places client per Settings - a reload that changes the profile creates a fresh client
+
+    google_maps_qps_per_key is the limit for the host, so each gunicorn worker process
+    (WEB_CONCURRENCY) keeps to its share of it.
+    '''
+
+    qps = config.google_maps_qps_per_key / get_worker_process_count()
+    key_pool = places_client.PlacesKeyPool(config.google_maps_api_keys, qps=qps)
+    return places_client.PlacesClient(key_pool,
+                                      fields=config.google_places_fields,
+                                      max_workers=config.google_places_concurrency)
+
+
+def get_worker_process_count():
+    '''Number of gunicorn worker processes sharing the API limits - 1 when WEB_CONCURRENCY is not set'''
+
+    try:
+        return max(int(os.environ.get('WEB_CONCURRENCY', 1)), 1)
+    except ValueError:
+        MAIN_LOGGER.warning('WEB_CONCURRENCY is not a number, assuming a single worker process')
+        return 1
+
+
+def places_results_to_dataframe(results, querytext):
+
+    df = pd.json_normalize(results)
+    df = df.drop(columns=['photos', 'types'], errors='ignore')
     df['query_text'] = querytext
+    df[places_store.FETCHED_AT_COLUMN] = pd.Timestamp(datetime.utcnow())
     extract_data_df = df.fillna(value={'opening_hours.open_now': False, 'permanently_closed': False, 'price_level' : 0.00})
     return extract_data_df
 
 
 def initialize_rest_api_helper(cfg, instance_name, logging_level):
-    username = cfg["username"]
-    password = cfg["password"]
-    access_token = cfg["access_token_id"]
-    token_secret = cfg["access_token_secret"]
-    server_url = cfg["server_url"]
-    site_id = cfg["site_id"] if cfg["site_id"] is not None else ""
+    username = cfg.username
+    password = cfg.password
+    access_token = cfg.access_token_id
+    token_secret = cfg.access_token_secret
+    server_url = cfg.server_url
+    site_id = cfg.site_id
+    inventory = get_inventory(cfg)
     # determine authentication method
     useUsername = True if (username and password) else False
     useAccessToken = True if (access_token and token_secret) and not useUsername else False
@@ -185,6 +359,7 @@ def initialize_rest_api_helper(cfg, instance_name, logging_level):
                                                                        access_token=access_token,
                                                                        token_secret=token_secret,
                                                                        logging_level=logging_level,
+                                                                       inventory=inventory,
                                                                        http_debug=False)
 
         if useUsername:
@@ -195,6 +370,7 @@ def initialize_rest_api_helper(cfg, instance_name, logging_level):
                                                                        username=username,
                                                                        password=password,
                                                                        logging_level=logging_level,
+                                                                       inventory=inventory,
                                                                        http_debug=False)
 
     else:
@@ -205,13 +381,42 @@ def initialize_rest_api_helper(cfg, instance_name, logging_level):
     return rest_helper
 
 
+def get_inventory_snapshot_path(config):
+    # one snapshot per profile - profiles can point at different servers and sites
+    return os.path.join(file_paths.DATA_DIR, f'{config.profile_name}-{file_paths.INVENTORY_FILE_NAME}')
+
+
+def get_inventory(config):
+    '''Content listings of the profile's inventory snapshot - None when there is no usable snapshot
+
+    The snapshot is parsed once and shared by every job until export_inventory replaces the file.
+    '''
+
+    snapshot_path = get_inventory_snapshot_path(config)
+    try:
+        stat = os.stat(snapshot_path)
+        return load_inventory_snapshot(snapshot_path, stat.st_mtime_ns, stat.st_size)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError, KeyError) as e:
+        MAIN_LOGGER.warning(f'Ignoring unreadable content inventory snapshot {snapshot_path}: {e}')
+        return None
+
+
+@functools.lru_cache(maxsize=8)
+def load_inventory_snapshot(snapshot_path, _mtime_ns, _size):
+    # keyed on the file's modification time and size, so a new export is picked up by the next job
+    return tableau_rest_api_helper.load_inventory_listings(snapshot_path)
+
+
 def setup_logging(log_file_name, console_logging_level):
     '''Configure console logging handler and file logging handler'''
 
     # create file handler
     fh_formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
     # fh = RotatingFileHandler(log_file_name, maxBytes=8000000, backupCount=10)  # roll at ~8MB
-    fh = logging.FileHandler(log_file_name, 'w+')
+    # append - every gunicorn worker process writes to the same log file
+    fh = logging.FileHandler(log_file_name, 'a')
     fh.setFormatter(fh_formatter)
 
     fh.setLevel(logging.DEBUG)
@@ -0,0 +1,257 @@
+"""
+Google Places Client
+Connection-pooled Places Text Search client that spreads queries across a pool of API keys,
+keeps every key within its QPS limit and runs many queries concurrently.
+
+Concurrency uses a thread pool; under the gevent gunicorn worker the threads are monkey-patched
+into greenlets, so waiting on the API is cooperative and does not block other requests.
+
+Rate limits and throttling are tracked per process. Key state is shared by every pool in the
+process, so a configuration reload keeps it; configure_keys sets each key's limit and re-enables
+denied keys, and across processes the caller divides the QPS limit.
+"""
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+LOGGER = logging.getLogger()
+
+TEXT_SEARCH_URL = 'https://maps.googleapis.com/maps/api/place/textsearch/json'
+
+# the API only accepts a next_page_token a short while after it has been issued
+PAGE_TOKEN_DELAY = 2.0
+PAGE_TOKEN_RETRIES = 3
+
+# a key over its query limit rests for KEY_THROTTLE_SECONDS, doubling on every further failure
+KEY_THROTTLE_SECONDS = 30.0
+KEY_THROTTLE_MAX_SECONDS = 3600.0
+# fail a request rather than wait longer than this for a key to come off its rest
+MAX_KEY_WAIT_SECONDS = 60.0
+MAX_KEY_ATTEMPTS = 5
+# network errors and 5xx responses are transient - retry soon without resting the key
+TRANSPORT_RETRY_DELAY = 0.5
+
+# every PlacesKey by API key - one lock guards them all as pools may share keys
+_KEYS = dict()
+_KEYS_LOCK = threading.Lock()
+
+
+def configure_keys(key_limits):
+    """Set the QPS limit of every key and re-enable keys that were denied, keeping throttle state
+
+    Args:
+        key_limits (dict): API key to maximum queries per second from this process
+    """
+    with _KEYS_LOCK:
+        for key, qps in key_limits.items():
+            if key not in _KEYS:
+                _KEYS[key] = PlacesKey(key, qps)
+            _KEYS[key].min_interval = 1.0 / qps
+            _KEYS[key].disabled = False
+
+
+class PlacesAPIError(Exception):
+    """Raised when the Places API returns an error that retrying with another key will not fix"""
+
+
+class PlacesKey:
+    """Rate limit and usage counters for a single API key
+
+    Args:
+        key (str): API key
+        qps (float): Maximum queries per second for the key
+    """
+
+    def __init__(self, key, qps):
+        self.key = key
+        self.min_interval = 1.0 / qps
+        self.next_slot = 0.0
+        self.requests = 0
+        self.errors = 0
+        self.throttled_until = 0.0
+        self.throttle_count = 0
+        self.disabled = False
+
+    @property
+    def name(self):
+        # never log a full API key
+        return f'...{self.key[-4:]}'
+
+
+class PlacesKeyPool:
+    """Pool of API keys - hands out the key with the earliest free request slot
+
+    Args:
+        keys (list): API keys
+        qps (float): Maximum queries per second for keys not already set up by configure_keys or
+            an earlier pool
+    """
+
+    def __init__(self, keys, qps=10.0):
+        if not keys:
+            raise ValueError('At least one Google Maps API key is required')
+        self._lock = _KEYS_LOCK
+        with self._lock:
+            self.keys = [self.__get_key(key, qps) for key in dict.fromkeys(keys)]
+
+    def acquire(self, preferred=None):
+        """Reserve a request slot and wait until it is due
+
+        Args:
+            preferred (PlacesKey): (Optional) Key to use if it is still usable, i.e. when paging
+
+        Returns:
+            PlacesKey
+        """
+        with self._lock:
+            now = time.monotonic()
+            if preferred is not None and not preferred.disabled:
+                key = preferred
+            else:
+                usable = [k for k in self.keys if not k.disabled]
+                if not usable:
+                    raise PlacesAPIError('All Google Maps API keys have been disabled')
+                key = min(usable, key=lambda k: max(k.next_slot, k.throttled_until))
+            slot = max(now, key.next_slot, key.throttled_until)
+            if slot - now > MAX_KEY_WAIT_SECONDS:
+                raise PlacesAPIError(f'Google Maps API key {key.name} is over its query limit for '
+                                     f'another {slot - now:.0f} seconds')
+            key.next_slot = slot + key.min_interval
+            key.requests += 1
+
+        wait = slot - time.monotonic()
+        if wait > 0:
+            time.sleep(wait)
+        return key
+
+    def report_success(self, key):
+        with self._lock:
+            key.throttle_count = 0
+
+    def report_error(self, key, throttled=False, disable=False):
+        with self._lock:
+            key.errors += 1
+            if disable:
+                key.disabled = True
+            elif throttled:
+                # escalate, so a key that has used up its daily quota is not retried every few seconds
+                rest = min(KEY_THROTTLE_SECONDS * 2 ** key.throttle_count, KEY_THROTTLE_MAX_SECONDS)
+                key.throttled_until = time.monotonic() + rest
+                key.throttle_count += 1
+
+    def stats(self):
+        """Usage counters for every key"""
+        with self._lock:
+            now = time.monotonic()
+            return [{'key': k.name, 'requests': k.requests, 'errors': k.errors, 'disabled': k.disabled,
+                     'throttled_seconds': round(max(k.throttled_until - now, 0.0))}
+                    for k in self.keys]
+
+    @staticmethod
+    def __get_key(key, qps):
+        # reuse the key's rate and throttle state from earlier pools, i.e. from before a configuration reload
+        if key not in _KEYS:
+            _KEYS[key] = PlacesKey(key, qps)
+        return _KEYS[key]
+
+
+class PlacesClient:
+    """Places Text Search client sharing one pooled HTTP session
+
+    Args:
+        key_pool (PlacesKeyPool): API keys to rotate across
+        fields (list): (Optional) Result fields to keep - the legacy Text Search endpoint has no field
+            mask, so results are trimmed as soon as each page is parsed
+        max_workers (int): Queries run at the same time by search_many
+        timeout (float): HTTP timeout in seconds
+    """
+
+    def __init__(self, key_pool, fields=None, max_workers=8, timeout=10.0):
+        self.key_pool = key_pool
+        self.fields = tuple(fields) if fields else None
+        self.max_workers = max_workers
+        self.timeout = timeout
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_workers)
+        self.session.mount('https://', adapter)
+
+    def text_search(self, query_text):
+        """Run a Text Search and follow every next_page_token
+
+        Returns:
+            List of place results
+        """
+        results = list()
+        response, key = self.__request({'query': query_text})
+        results.extend(response.get('results', []))
+        while 'next_page_token' in response:
+            response, key = self.__next_page(response['next_page_token'], key)
+            results.extend(response.get('results', []))
+
+        if self.fields:
+            results = [{field: place[field] for field in self.fields if field in place} for place in results]
+        LOGGER.debug(f'Google Places returned {len(results)} results for query [{query_text}]')
+        return results
+
+    def search_many(self, queries):
+        """Run several Text Searches concurrently within each key's rate limit
+
+        Returns:
+            Dict of query text to list of place results, in the order the queries were given
+        """
+        queries = list(dict.fromkeys(queries))
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(queries) or 1)) as executor:
+            return dict(zip(queries, executor.map(self.text_search, queries)))
+
+    def __next_page(self, page_token, key):
+        for attempt in range(PAGE_TOKEN_RETRIES):
+            time.sleep(PAGE_TOKEN_DELAY)
+            try:
+                # page tokens are tied to the request, so page with the same key where possible
+                return self.__request({'pagetoken': page_token}, preferred=key)
+            except _PageTokenNotReady:
+                continue
+        raise PlacesAPIError('next_page_token did not become valid')
+
+    def __request(self, params, preferred=None):
+        for attempt in range(MAX_KEY_ATTEMPTS):
+            key = self.key_pool.acquire(preferred)
+            try:
+                response = self.session.get(TEXT_SEARCH_URL, params={**params, 'key': key.key},
+                                            timeout=self.timeout)
+                response.raise_for_status()
+                payload = response.json()
+            except requests.RequestException as e:
+                LOGGER.warning(f'Google Places request failed with key {key.name}: {e}')
+                self.key_pool.report_error(key)
+                time.sleep(TRANSPORT_RETRY_DELAY * 2 ** attempt)
+                preferred = None
+                continue
+
+            status = payload.get('status')
+            if status in ('OK', 'ZERO_RESULTS'):
+                self.key_pool.report_success(key)
+                return payload, key
+            if status == 'INVALID_REQUEST' and 'pagetoken' in params:
+                raise _PageTokenNotReady()
+            if status == 'OVER_QUERY_LIMIT':
+                LOGGER.warning(f'Google Places quota exceeded for key {key.name}, rotating key')
+                self.key_pool.report_error(key, throttled=True)
+            elif status == 'REQUEST_DENIED':
+                LOGGER.error(f'Google Places denied key {key.name}: {payload.get("error_message")}')
+                self.key_pool.report_error(key, disable=True)
+            else:
+                self.key_pool.report_error(key)
+                raise PlacesAPIError(f'Google Places returned {status}: {payload.get("error_message")}')
+            preferred = None
+
+        raise PlacesAPIError(f'Google Places request failed after {MAX_KEY_ATTEMPTS} attempts')
+
+
+class _PageTokenNotReady(Exception):
+    pass
@@ -0,0 +1,232 @@
+"""
+Google Places Landing Zone
+Persists every Google Places fetch as an Arrow IPC file partitioned by query and fetch date,
+so Hyper files can be rebuilt from history without calling the Places API again.
+
+Layout:
+    <root>/query=<url-quoted query text>/date=<YYYY-MM-DD>/part-<timestamp>-<id>.arrow
+
+Files are written uncompressed so reads are memory-mapped and zero-copy. A compacted file names the
+files it replaces in its schema metadata; those are hidden from readers at once and removed by a
+later compaction.
+"""
+import json
+import logging
+import os
+import time
+import uuid
+from datetime import date, datetime
+from urllib.parse import quote
+
+import pandas as pd
+import pyarrow as pa
+
+from refresh_extract import utilities as utils
+
+LOGGER = logging.getLogger()
+
+FETCHED_AT_COLUMN = 'fetched_at'
+SMALL_FILE_BYTES = 8 * 1024 * 1024
+# replaced files outlive their compacted file by this long, so reads that listed them can finish
+REPLACED_RETAIN_SECONDS = 600.0
+REPLACES_METADATA_KEY = b'replaces'
+READ_ATTEMPTS = 3
+
+
+class PlacesStore:
+    """Partitioned Arrow IPC store of fetched Google Places results
+
+    Args:
+        root_dir (str): Directory holding the partitions (created if missing)
+    """
+
+    def __init__(self, root_dir):
+        self.root_dir = root_dir
+        utils.check_and_create_dir(root_dir)
+
+    def write(self, df, query_text, fetched_at=None):
+        """Persist one fetch as a new file in its query/date partition
+
+        Args:
+            df (DataFrame): Places results for the query
+            query_text (str): Google Places query the results came from
+            fetched_at (datetime): (Optional) UTC fetch time - defaults to the fetched_at column or now
+
+        Returns:
+            Path to the written file
+        """
+        if fetched_at is None:
+            fetched_at = df[FETCHED_AT_COLUMN].max() if FETCHED_AT_COLUMN in df and len(df) else datetime.utcnow()
+
+        partition_dir = os.path.join(self.root_dir, f'query={quote(query_text, safe="")}',
+                                     f'date={fetched_at:%Y-%m-%d}')
+        utils.check_and_create_dir(partition_dir)
+        file_path = os.path.join(partition_dir, f'part-{fetched_at:%Y%m%dT%H%M%S}-{uuid.uuid4().hex[:8]}.arrow')
+
+        self.__write_table(pa.Table.from_pandas(df, preserve_index=False), file_path)
+        LOGGER.debug(f'Landed {len(df)} Google Places rows for query [{query_text}] in {file_path}')
+        return file_path
+
+    def read(self, queries=None, start_date=None, end_date=None):
+        """Read the stored results for a subset of queries and fetch dates
+
+        Args:
+            queries (list): (Optional) Query texts to include - all queries when not given
+            start_date (date): (Optional) First fetch date to include
+            end_date (date): (Optional) Last fetch date to include
+
+        Returns:
+            DataFrame of every matching row
+        """
+        for attempt in range(READ_ATTEMPTS):
+            try:
+                tables = [self.__read_table(path) for path in self.list_files(queries, start_date, end_date)]
+                break
+            except FileNotFoundError:
+                # a compaction removed a listed file - list the partitions again
+                if attempt == READ_ATTEMPTS - 1:
+                    raise
+        if not tables:
+            return pd.DataFrame()
+        return self.__concat(tables).to_pandas()
+
+    def list_files(self, queries=None, start_date=None, end_date=None):
+        """Return the paths of the stored files matching the filters"""
+        return [path for partition_dir in self.__partitions(queries, start_date, end_date)
+                for path in self.__live_files(partition_dir)[0]]
+
+    def compact(self, small_file_bytes=SMALL_FILE_BYTES, retain_seconds=REPLACED_RETAIN_SECONDS):
+        """Merge the small files of every partition into one file per partition
+
+        Readers switch to the merged file as soon as it is in place, so they never see rows twice or
+        miss any. The replaced files are only removed by a compaction at least retain_seconds later,
+        so reads that listed them before the switch can still open them.
+
+        Args:
+            small_file_bytes (int): Files smaller than this are merged
+            retain_seconds (float): Seconds to keep the replaced files after they were merged
+
+        Returns:
+            Number of files removed
+        """
+        removed = 0
+        for partition_dir in self.__partitions():
+            live_files, replacements = self.__live_files(partition_dir)
+
+            # the newest compacted file lists every file it replaced, including those of earlier compactions
+            expired = set()
+            for path, replaced in replacements.items():
+                if path in live_files and time.time() - os.path.getmtime(path) > retain_seconds:
+                    expired.update(replaced)
+            for path in expired:
+                if os.path.exists(path):
+                    os.remove(path)
+                    removed += 1
+
+            small_files = [path for path in live_files if os.path.getsize(path) < small_file_bytes]
+            if len(small_files) < 2:
+                continue
+
+            merged = self.__concat([self.__read_table(path) for path in small_files])
+            replaced = set(small_files)
+            for path in small_files:
+                replaced.update(replacements.get(path, ()))
+            replaced = sorted(os.path.basename(path) for path in replaced)
+            merged = merged.replace_schema_metadata({**(merged.schema.metadata or {}),
+                                                     REPLACES_METADATA_KEY: json.dumps(replaced).encode()})
+            merged_path = os.path.join(partition_dir, f'part-{datetime.utcnow():%Y%m%dT%H%M%S}-'
+                                                      f'{uuid.uuid4().hex[:8]}-compacted.arrow')
+            self.__write_table(merged, merged_path)
+            LOGGER.debug(f'Compacted {len(small_files)} files in {partition_dir}')
+
+        if removed:
+            LOGGER.info(f'Google Places store compaction removed {removed} files')
+        return removed
+
+    def __live_files(self, partition_dir):
+        """Files of a partition not replaced by a compacted file, and what each compacted file replaces"""
+        files = self.__partition_files(partition_dir)
+        replacements = {path: [os.path.join(partition_dir, name) for name in self.__replaced_names(path)]
+                        for path in files if path.endswith('-compacted.arrow')}
+        replaced = {path for paths in replacements.values() for path in paths}
+        return [path for path in files if path not in replaced], replacements
+
+    def __partitions(self, queries=None, start_date=None, end_date=None):
+        query_names = [f'query={quote(q, safe="")}' for q in queries] if queries else \
+            [name for name in os.listdir(self.root_dir) if name.startswith('query=')]
+
+        for query_name in query_names:
+            query_dir = os.path.join(self.root_dir, query_name)
+            if not os.path.isdir(query_dir):
+                continue
+            for date_name in sorted(os.listdir(query_dir)):
+                if not date_name.startswith('date='):
+                    continue
+                try:
+                    partition_date = date.fromisoformat(date_name[len('date='):])
+                except ValueError:
+                    LOGGER.warning(f'Skipping malformed Google Places store partition {os.path.join(query_dir, date_name)}')
+                    continue
+                if start_date and partition_date < start_date:
+                    continue
+                if end_date and partition_date > end_date:
+                    continue
+                yield os.path.join(query_dir, date_name)
+
+    @staticmethod
+    def __partition_files(partition_dir):
+        return [os.path.join(partition_dir, name) for name in sorted(os.listdir(partition_dir))
+                if name.endswith('.arrow')]
+
+    @staticmethod
+    def __replaced_names(file_path):
+        metadata = pa.ipc.open_file(pa.memory_map(file_path, 'r')).schema.metadata or {}
+        return json.loads(metadata[REPLACES_METADATA_KEY]) if REPLACES_METADATA_KEY in metadata else []
+
+    @staticmethod
+    def __read_table(file_path):
+        # memory-mapped IPC reads reference the file's pages directly rather than copying them
+        return pa.ipc.open_file(pa.memory_map(file_path, 'r')).read_all()
+
+    @staticmethod
+    def __write_table(table, file_path):
+        tmp_path = f'{file_path}.tmp'
+        with pa.OSFile(tmp_path, 'wb') as sink:
+            with pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+        # rename so readers never see a partially written file
+        os.replace(tmp_path, file_path)
+
+    @staticmethod
+    def __concat(tables):
+        try:
+            # fetches can differ in columns, promote fills the missing ones with nulls
+            return pa.concat_tables(tables, promote=True)
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            # a column changed type between fetches (i.e. all-integer ratings) - let pandas unify it
+            return pa.Table.from_pandas(pd.concat([table.to_pandas() for table in tables], ignore_index=True),
+                                        preserve_index=False)
+
+
+def run_compaction(store, backend, owner, sleep=time.sleep, interval=3600.0):
+    """Compact the store every interval seconds - runs forever as a background task
+
+    The job backend lock makes sure only one worker compacts at a time.
+
+    Args:
+        store (PlacesStore): Store to compact
+        backend (JobBackend): Shared job backend providing the lock
+        owner (str): Lock owner identifier
+        sleep (callable): Sleep function, i.e. socketio.sleep when running under an async worker
+        interval (float): Seconds between compactions
+    """
+    while True:
+        sleep(interval)
+        try:
+            if backend.acquire_lock('places-store-compaction', owner, ttl_seconds=interval):
+                try:
+                    store.compact()
+                finally:
+                    backend.release_lock('places-store-compaction', owner)
+        except Exception as e:
+            LOGGER.exception(e)
@@ -3,14 +3,66 @@ Tableau REST API Helper
 Makes use of Tableau Server Client Python library to interface with Tableau REST API
 Manages state - initiates one REST API connection per instance of the class
 """
+import gzip
+import json
 import logging
+import math
 import os
+import shutil
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime
 from http.client import HTTPConnection
+from types import SimpleNamespace
 import tableauserverclient as TSC
 from tableauserverclient import ServerResponseError
 
 from refresh_extract import utilities as utils
 
+# content listed by the bulk inventory export, in the order they are requested
+INVENTORY_RESOURCES = ('projects', 'workbooks', 'datasources', 'views', 'flows', 'users')
+# users cannot be filtered on updatedAt, so a delta export always lists them in full
+DELTA_RESOURCES = ('projects', 'workbooks', 'datasources', 'views', 'flows')
+INVENTORY_FIELDS = ('id', 'name', 'content_url', 'project_id', 'project_name', 'workbook_id', 'parent_id',
+                    'owner_id', 'site_role', 'updated_at')
+INVENTORY_PAGE_SIZE = 1000
+
+
+class InventoryItem(SimpleNamespace):
+    """Lightweight stand-in for a TSC item loaded from an inventory snapshot"""
+
+    def __getattr__(self, name):
+        # attributes the resource type does not have (i.e. a user's project_name) read as None
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return None
+
+
+def read_inventory_snapshot(snapshot_path):
+    '''Read the records of an inventory snapshot written by export_inventory, by resource and id'''
+    items = {resource: dict() for resource in INVENTORY_RESOURCES}
+    with gzip.open(snapshot_path, 'rt', encoding='utf-8') as snapshot:
+        header = json.loads(snapshot.readline())
+        for line in snapshot:
+            record = json.loads(line)
+            items[record['type']][record['id']] = record
+    # snapshots written before per-listing timestamps share the snapshot time for every listing
+    listed_at = header.get('listed_at') or {resource: header['snapshot_at'] for resource in INVENTORY_RESOURCES}
+    return {'snapshot_at': header['snapshot_at'], 'listed_at': listed_at, 'items': items}
+
+
+def load_inventory_listings(snapshot_path):
+    '''Build the content listings of an inventory snapshot - parse once and share between helper instances
+
+    Returns:
+        Dict with the snapshot time and a tuple of InventoryItems per listing
+    '''
+    snapshot = read_inventory_snapshot(snapshot_path)
+    # a listing that has never been exported successfully is left to be listed live
+    listings = {resource: tuple(InventoryItem(**record) for record in snapshot['items'][resource].values())
+                for resource in INVENTORY_RESOURCES if snapshot['listed_at'][resource]}
+    return {'snapshot_at': snapshot['snapshot_at'], 'listings': listings}
+
 
 class TableauRestAPIHelper:
     """API Helper Class for the Tableau REST API via the Tableau Server Client library
@@ -23,6 +75,7 @@ class TableauRestAPIHelper:
         access_token (kwarg): Specify access token ID for authentication
         token_secret (kwarg): Specify token secret for token
         http-debug (kwarg): True for verbose HTTPConnection logging of request/response
+        inventory (kwarg): Content listings from load_inventory_listings to use for lookups
 
     """
 
@@ -58,9 +111,18 @@ class TableauRestAPIHelper:
         self.all_users = None
         self.all_flows = None
         self.all_tasks = None
+        self.last_publish_bytes = None
+        self.last_publish_seconds = None
+        self.inventory_snapshot_at = None
+        self.snapshot_listings = set()
 
         self.__create_session_and_signin()
 
+        # cached listings from a bulk inventory snapshot save listing the whole site on first lookup
+        inventory = kwargs.get("inventory")
+        if inventory:
+            self.use_inventory(inventory)
+
     def __del__(self):
         try:
             if self.tsclient and self.tsclient.is_signed_in():
@@ -83,15 +145,144 @@ class TableauRestAPIHelper:
         self.logger.info(info)
 
     def list_workbooks(self):
-        workbooks, pagination_item = self.tsclient.workbooks.get()
-        for workbook in workbooks:
+        if not self.all_workbooks:
+            self.all_workbooks = list(TSC.Pager(self.tsclient.workbooks))
+        for workbook in self.all_workbooks:
             self.logger.info(f"Workbook Name: {workbook.name} Workbook LUID: {workbook.id}")
 
     def list_projects(self):
-        projects, pagination_item = self.tsclient.projects.get()
-        for project in projects:
+        if not self.all_projects:
+            self.all_projects = list(TSC.Pager(self.tsclient.projects))
+        for project in self.all_projects:
             self.logger.info(f"Project Name: {project.name} Project LUID: {project.id}")
 
+    def export_inventory(self, snapshot_path, delta=False, max_workers=8, page_size=INVENTORY_PAGE_SIZE):
+        '''Export the site's content inventory to a gzipped JSON Lines snapshot
+
+        Every listing is requested at the same time; once a listing's first page reports the total
+        count, its remaining pages are requested in parallel. Records are written as pages arrive.
+        A listing that fails (i.e. no permission to list users) keeps its records from the existing
+        snapshot, or is left empty, without failing the rest of the export.
+
+        Args:
+            snapshot_path (str): Path to the snapshot file
+            delta (bool): Only request content updated since the existing snapshot and merge it in.
+                Deleted content is only dropped by a full export
+            max_workers (int): Number of requests in flight at the same time
+            page_size (int): Items per page (max 1000)
+
+        Returns:
+            Dict of resource name to number of items in the snapshot
+        '''
+
+        snapshot_at = datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')
+        previous = read_inventory_snapshot(snapshot_path) if os.path.exists(snapshot_path) else None
+        since = {resource: previous['listed_at'][resource] if delta and previous and resource in DELTA_RESOURCES
+                 else None for resource in INVENTORY_RESOURCES}
+        if delta and previous:
+            self.logger.info(f'Delta inventory export of content updated since {previous["snapshot_at"]}')
+
+        counts = {resource: 0 for resource in INVENTORY_RESOURCES}
+        updates = {resource: dict() for resource in INVENTORY_RESOURCES}
+        failed = set()
+        tmp_path = f'{snapshot_path}.tmp'
+        # each listing streams into its own gzip member, so a failed listing can be swapped out on its own
+        part_paths = {resource: f'{snapshot_path}.{resource}.tmp' for resource in INVENTORY_RESOURCES}
+        parts = {resource: gzip.open(path, 'wt', encoding='utf-8') for resource, path in part_paths.items()}
+        try:
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                pending = {executor.submit(self.__get_inventory_page, resource, 1, page_size, since[resource]):
+                           (resource, 1) for resource in INVENTORY_RESOURCES}
+                while pending:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        resource, page_number = pending.pop(future)
+                        if resource in failed:
+                            continue
+                        try:
+                            items, pagination_item = future.result()
+                        except ServerResponseError as e:
+                            self.logger.error(utils.get_formatted_error(f'Unable to list {resource} for the '
+                                                                        f'content inventory', e))
+                            failed.add(resource)
+                            continue
+                        if page_number == 1:
+                            last_page = math.ceil(int(pagination_item.total_available) / page_size)
+                            for next_page in range(2, last_page + 1):
+                                pending[executor.submit(self.__get_inventory_page, resource, next_page, page_size,
+                                                        since[resource])] = (resource, next_page)
+
+                        for item in items:
+                            record = self.__to_inventory_record(resource, item)
+                            if since[resource]:
+                                updates[resource][record['id']] = record
+                            else:
+                                parts[resource].write(json.dumps(record) + '\n')
+                                counts[resource] += 1
+
+            listed_at = dict()
+            for resource in INVENTORY_RESOURCES:
+                if resource in failed or since[resource]:
+                    # rewrite the listing from the existing snapshot, merged with any delta updates
+                    records = dict(previous['items'][resource]) if previous else dict()
+                    if resource not in failed:
+                        records.update(updates[resource])
+                    parts[resource].close()
+                    parts[resource] = gzip.open(part_paths[resource], 'wt', encoding='utf-8')
+                    for record in records.values():
+                        parts[resource].write(json.dumps(record) + '\n')
+                    counts[resource] = len(records)
+                if resource in failed:
+                    listed_at[resource] = previous['listed_at'][resource] if previous else None
+                else:
+                    listed_at[resource] = snapshot_at
+                parts[resource].close()
+
+            with open(tmp_path, 'wb') as snapshot:
+                with gzip.open(snapshot, 'wt', encoding='utf-8') as header:
+                    header.write(json.dumps({'snapshot_at': snapshot_at, 'listed_at': listed_at,
+                                             'server_url': self.server_url, 'site': self.site_content_url}) + '\n')
+                # concatenated gzip members read back as one stream
+                for resource in INVENTORY_RESOURCES:
+                    with open(part_paths[resource], 'rb') as part:
+                        shutil.copyfileobj(part, snapshot)
+            os.replace(tmp_path, snapshot_path)
+        finally:
+            for part in parts.values():
+                part.close()
+            for path in (tmp_path, *part_paths.values()):
+                if os.path.exists(path):
+                    os.remove(path)
+
+        if failed:
+            self.logger.warning(f'Content inventory export could not list {", ".join(sorted(failed))} - '
+                                f'kept their previous records where available')
+        self.logger.info(f'Exported content inventory to {snapshot_path}: {counts}')
+        self.load_inventory(snapshot_path)
+        return counts
+
+    def load_inventory(self, snapshot_path):
+        '''Populate the cached content listings used by the lookup helpers from an inventory snapshot
+
+        Args:
+            snapshot_path (str): Path to a snapshot written by export_inventory
+        '''
+
+        self.use_inventory(load_inventory_listings(snapshot_path))
+
+    def use_inventory(self, inventory):
+        '''Populate the cached content listings used by the lookup helpers from already loaded listings
+
+        Args:
+            inventory (dict): Listings returned by load_inventory_listings
+        '''
+
+        for resource, items in inventory['listings'].items():
+            setattr(self, f'all_{resource}', list(items))
+        self.inventory_snapshot_at = inventory['snapshot_at']
+        self.snapshot_listings = set(inventory['listings'])
+        self.logger.debug(f'Using content inventory snapshot from {inventory["snapshot_at"]}')
+
 
     def download_datasource(self, datasource_name, download_dir, project_name=None, _include_extract=False, _cleanup_after=True):
         '''Downloads Tableau Published Datasource
@@ -168,16 +359,24 @@ class TableauRestAPIHelper:
 
         # call the publish method with the datasource item
         try:
+            publish_start = time.perf_counter()
             published_ds_item = self.tsclient.datasources.publish(dest_datasource_item, source_hyper_file_path, mode)
+            self.last_publish_seconds = time.perf_counter() - publish_start
+            self.last_publish_bytes = os.path.getsize(source_hyper_file_path)
         except ServerResponseError as e:
             self.logger.error(utils.get_formatted_error('Unable to Publish Datasource', e))
+            # a missing project may have been recreated since the inventory snapshot - retry once with a live listing
+            if str(e.code).startswith('404') and self.__refresh_snapshot_listing('projects'):
+                self.logger.info('Retrying publish with the live project listing')
+                return self.publish_hyper(source_hyper_file_path, dest_datasource_name, dest_project_name, overwrite)
             return False
         except Exception as e:
             self.logger.exception(e)
             return False
 
 
-        action_msg = f'Published Hyper File as Datasource "{published_ds_item.name}" to Project "{dest_project_name}"'
+        action_msg = f'Published Hyper File as Datasource "{published_ds_item.name}" to Project "{dest_project_name}" ' \
+                     f'({self.last_publish_bytes} bytes in {self.last_publish_seconds:.1f}s)'
 
 
         self.logger.info(action_msg)
@@ -233,6 +432,31 @@ class TableauRestAPIHelper:
         except:
             self.logger.debug("Unable to signout of TS session...")
 
+    def __refresh_snapshot_listing(self, resource):
+        '''Replace a listing loaded from an inventory snapshot with a live one - False if it is already live'''
+        if resource not in self.snapshot_listings:
+            return False
+        self.logger.debug(f'Replacing the {resource} listing from the inventory snapshot with a live one')
+        self.snapshot_listings.discard(resource)
+        setattr(self, f'all_{resource}', list(TSC.Pager(getattr(self.tsclient, resource))))
+        return True
+
+    def __get_inventory_page(self, resource, page_number, page_size, updated_since=None):
+        options = TSC.RequestOptions(pagenumber=page_number, pagesize=page_size)
+        if updated_since:
+            options.filter.add(TSC.Filter(TSC.RequestOptions.Field.UpdatedAt,
+                                          TSC.RequestOptions.Operator.GreaterThanOrEqual, updated_since))
+        return getattr(self.tsclient, resource).get(options)
+
+    @staticmethod
+    def __to_inventory_record(resource, item):
+        record = {'type': resource}
+        for field in INVENTORY_FIELDS:
+            value = getattr(item, field, None)
+            if value is not None:
+                record[field] = value.isoformat() if isinstance(value, datetime) else value
+        return record
+
     def __get_restapi_token(self):
         return self.tsclient.auth_token
 
@@ -282,6 +506,8 @@ class TableauRestAPIHelper:
                 luid = pj.id
         if luid:
             return luid
+        elif self.__refresh_snapshot_listing('projects'):
+            return self.__get_project_luid(project_name)
         else:
             raise LookupError(f'Project with the specified name was not found: {project_name}')
 
@@ -300,6 +526,8 @@ class TableauRestAPIHelper:
 
         if item:
             return item
+        elif self.__refresh_snapshot_listing('users'):
+            return self.__get_user_item(user_name)
         else:
             raise LookupError(f'User with the specified name was not found: {user_name}')
 
@@ -324,6 +552,8 @@ class TableauRestAPIHelper:
 
         if workbook_item:
             return workbook_item
+        elif self.__refresh_snapshot_listing('workbooks'):
+            return self.__get_workbook_item(workbook_name, project_name)
         else:
             raise LookupError(f'Workbook with the specified name was not found: {workbook_name}')
 
@@ -350,6 +580,8 @@ class TableauRestAPIHelper:
 
         if item:
             return item
+        elif self.__refresh_snapshot_listing('datasources'):
+            return self.__get_datasource_item(datasource_name, project_name)
         else:
             raise LookupError(f'Datasource with the specified name was not found: {datasource_name}')
 
@@ -364,6 +596,8 @@ class TableauRestAPIHelper:
                 for view_item in self.all_views :
                     if workbook_item.id == view_item.workbook_id and view_item.name == view_name:
                         return view_item
+                if self.__refresh_snapshot_listing('views'):
+                    return self.__get_view_item(view_name, workbook_name, project_name)
             else:
                 return None
         else:
@@ -390,6 +624,8 @@ class TableauRestAPIHelper:
 
         if item:
             return item
+        elif self.__refresh_snapshot_listing('flows'):
+            return self.__get_flow_item(flow_name, project_name)
         else:
             raise LookupError(f'Prep Flow with the specified name was not found: {flow_name}')
 